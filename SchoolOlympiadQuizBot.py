@@ -1,16 +1,30 @@
+import io
 import os
+import json
+import asyncio
+import itertools
+import collections
+import contextlib
 import logging
 import sqlite3
-import tempfile
+import threading
+import time
 import zipfile
 import shutil
+import signal
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import BadRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
-    ContextTypes, ConversationHandler, filters, PicklePersistence
+    ContextTypes, ConversationHandler, filters, BasePersistence, PersistenceInput
 )
 import openpyxl
 
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # без calamine читаем Excel через openpyxl
+    CalamineWorkbook = None
+
 # Тексты кнопок
 BTN_START = "Начать"
 BTN_BACK_TO_YEAR = "К выбору года"
@@ -18,6 +32,31 @@ BTN_BACK_TO_EXERCISES = "К выбору задач"
 BTN_HINT = "Подсказка"
 BTN_ANSWER = "Ответ"
 BTN_TOPIC_EXERCISES = "Задачи по теме"
+BTN_ADMIN = "🛡️ Админка"
+BTN_ADMIN_REPLACE = "📁 Загрузить данные"
+BTN_ADMIN_APPEND = "📥 Дополнить данные"
+BTN_ADMIN_CLEAR = "🧹 Удалить данные"
+BTN_ADMIN_EXIT = "↩️ Выйти"
+
+# Статические клавиатуры: собираются один раз при импорте и переиспользуются во всех ответах
+KB_START = ReplyKeyboardMarkup([[BTN_START]], resize_keyboard=True)
+KB_START_ADMIN = ReplyKeyboardMarkup([[BTN_START], [BTN_ADMIN]], resize_keyboard=True)
+KB_TASK = ReplyKeyboardMarkup([
+    [BTN_HINT, BTN_ANSWER],
+    [BTN_TOPIC_EXERCISES, BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR]
+], one_time_keyboard=False)
+KB_HINT = ReplyKeyboardMarkup([
+    [BTN_ANSWER],
+    [BTN_TOPIC_EXERCISES, BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR]
+], one_time_keyboard=False)
+KB_ANSWER = ReplyKeyboardMarkup([
+    [BTN_TOPIC_EXERCISES, BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR]
+], one_time_keyboard=False)
+KB_ADMIN_MENU = ReplyKeyboardMarkup([
+    [BTN_ADMIN_REPLACE, BTN_ADMIN_APPEND],
+    [BTN_ADMIN_CLEAR, BTN_ADMIN_EXIT]
+], resize_keyboard=True)
+KB_CONFIRM_CLEAR = ReplyKeyboardMarkup([['✅ Да', '❌ Нет']])
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,15 +64,134 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx пишет INFO на каждый запрос к Bot API, в режиме polling это каждый getUpdates
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Состояния
 (CHOOSE_YEAR, CHOOSE_EXERCISE, CHOOSE_TOPIC_EXERCISE, TASK, HINT, ANSWER,
  ADMIN_MENU, ADMIN_UPLOAD_REPLACE, ADMIN_UPLOAD_APPEND, ADMIN_CONFIRM_CLEAR) = range(10)
 
+# Кнопки меню админки: текст ответа, клавиатура и следующее состояние
+ADMIN_ACTIONS = {
+    BTN_ADMIN_EXIT: ("Вы вышли.", ReplyKeyboardRemove(), ConversationHandler.END),
+    BTN_ADMIN_REPLACE: ("Отправьте ZIP-архив с Excel и изображениями.", None, ADMIN_UPLOAD_REPLACE),
+    BTN_ADMIN_APPEND: ("Отправьте ZIP-архив с Excel и изображениями для дополнения.", None, ADMIN_UPLOAD_APPEND),
+    BTN_ADMIN_CLEAR: ("Точно удалить все данные?", KB_CONFIRM_CLEAR, ADMIN_CONFIRM_CLEAR),
+}
+
 # Папка для изображений
 IMAGE_DIR = "images"
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png')
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
+# Сколько пользовательских состояний держим в памяти; самые давние вытесняются (остаются в БД)
+MAX_ACTIVE_USERS = 10_000
+# Состояния, не обновлявшиеся дольше этого срока (в секундах), удаляются из БД при запуске
+USER_STATE_TTL = 7 * 24 * 3600
+
+# Фоновая запись в БД: копим WRITE_FLUSH_DELAY секунд, пишем до WRITE_BATCH_SIZE за транзакцию
+WRITE_FLUSH_DELAY = 0.05
+WRITE_BATCH_SIZE = 500
+
+# Сигнатура ZIP: с неё начинаются и загружаемый архив, и .xlsx внутри него
+ZIP_MAGIC = b'PK\x03\x04'
+
+# После стольких пустых строк подряд считаем, что данные в листе закончились (только для openpyxl)
+MAX_EMPTY_ROWS = 100
+# Ограничение Telegram на длину подписи к фото
+CAPTION_LIMIT = 1024
+
+# SQL частых запросов: один и тот же текст попадает в кэш подготовленных выражений sqlite3
+SQL_INSERT_USER = '''INSERT OR IGNORE INTO users (id, first_name, username) VALUES (?, ?, ?)'''
+SQL_INSERT_YEAR = "INSERT OR IGNORE INTO years (year) VALUES (?)"
+SQL_SELECT_YEAR_IDS = "SELECT year, id FROM years"
+SQL_INSERT_TOPIC = "INSERT OR IGNORE INTO topics (name) VALUES (?)"
+SQL_SELECT_TOPIC_IDS = "SELECT name, id FROM topics"
+SQL_UPSERT_OLYMPIAD = '''INSERT INTO olympiads
+                         (year_id, excercise, task, task_picture,
+                          hint, hint_picture, answer, answer_picture)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (year_id, excercise) DO UPDATE SET
+                             task = excluded.task,
+                             task_picture = excluded.task_picture,
+                             hint = excluded.hint,
+                             hint_picture = excluded.hint_picture,
+                             answer = excluded.answer,
+                             answer_picture = excluded.answer_picture'''
+SQL_SELECT_OLYMPIAD_IDS = "SELECT year_id, excercise, id FROM olympiads"
+SQL_CREATE_TOPIC_INDEX = '''CREATE INDEX IF NOT EXISTS idx_olympiad_topics_topic_olympiad
+                            ON olympiad_topics(topic_id, olympiad_id)'''
+SQL_DELETE_OLYMPIAD_TOPICS = "DELETE FROM olympiad_topics WHERE olympiad_id = ?"
+SQL_INSERT_OLYMPIAD_TOPIC = '''INSERT OR IGNORE INTO olympiad_topics (olympiad_id, topic_id) VALUES (?, ?)'''
+SQL_SELECT_CONVERSATIONS = "SELECT key, state FROM conversations WHERE name = ?"
+SQL_UPSERT_CONVERSATION = "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)"
+SQL_DELETE_CONVERSATION = "DELETE FROM conversations WHERE name = ? AND key = ?"
+SQL_UPSERT_PHOTO_ID = "INSERT OR REPLACE INTO photo_file_ids (name, file_id) VALUES (?, ?)"
+SQL_DELETE_PHOTO_ID = "DELETE FROM photo_file_ids WHERE name = ?"
+SQL_SELECT_USER_STATE = "SELECT year, excercise FROM user_states WHERE user_id = ?"
+SQL_UPSERT_USER_STATE = "INSERT OR REPLACE INTO user_states (user_id, year, excercise, updated_at) VALUES (?, ?, ?, ?)"
+SQL_DELETE_USER_STATE = "DELETE FROM user_states WHERE user_id = ?"
+SQL_SELECT_YEARS = "SELECT year FROM years ORDER BY year"
+SQL_SELECT_EXERCISES_FOR_YEAR = '''SELECT o.excercise
+                                   FROM olympiads o
+                                   JOIN years y ON o.year_id = y.id
+                                   WHERE y.year = ?
+                                   ORDER BY o.excercise'''
+SQL_SELECT_YEAR_TASKS = '''SELECT o.id, o.excercise, o.task, o.task_picture,
+                                  o.hint, o.hint_picture,
+                                  o.answer, o.answer_picture
+                           FROM olympiads o
+                           JOIN years y ON o.year_id = y.id
+                           WHERE y.year = ?'''
+SQL_SELECT_YEAR_TASK_TOPICS = '''SELECT ot.olympiad_id, t.name
+                                 FROM olympiad_topics ot
+                                 JOIN topics t ON t.id = ot.topic_id
+                                 JOIN olympiads o ON o.id = ot.olympiad_id
+                                 JOIN years y ON o.year_id = y.id
+                                 WHERE y.year = ?
+                                 ORDER BY ot.olympiad_id, ot.topic_id'''
+
+# Задание из кэша: неизменяемая запись вместо словаря на каждое задание
+Task = collections.namedtuple('Task', [
+    'id', 'excercise', 'task', 't_pic', 'hint', 'h_pic', 'answer', 'a_pic', 'topics',
+    'task_text', 'hint_text', 'answer_text', 'topics_str'
+])
+
+# Итог загрузки Excel
+ImportResult = collections.namedtuple('ImportResult', ['inserted', 'skipped'])
+
+def _read_file(path):
+    """Читает файл целиком (для вызова через asyncio.to_thread)."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _list_files(directory):
+    """Имена файлов в папке одним scandir: проверка наличия — поиск в множестве, а не stat на каждый файл."""
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
+
+def _is_stale_file_id(error):
+    """BadRequest из-за недействительного file_id."""
+    message = error.message.lower()
+    return 'file identifier' in message or 'file_id' in message
+
+def _until_blank_run(rows):
+    """Строки листа до первых MAX_EMPTY_ROWS пустых строк подряд.
+
+    openpyxl в read-only режиме отдаёт и отформатированные пустые строки, и такой «хвост» листа
+    может тянуться на тысячи строк. Calamine отдаёт только занятый диапазон, ему это не нужно.
+    """
+    empty_run = 0
+    for row_num, row in enumerate(rows, start=1):
+        if any(row):
+            empty_run = 0
+        else:
+            empty_run += 1
+            if empty_run >= MAX_EMPTY_ROWS:
+                logger.info(f"Reading ended at row {row_num - MAX_EMPTY_ROWS + 1}: {MAX_EMPTY_ROWS} empty rows in a row")
+                return
+        yield row
+
 def chunks(lst, n):
     """Разбивает список на подсписки по n элементов."""
     return [lst[i:i + n] for i in range(0, len(lst), n)]
@@ -42,13 +200,134 @@ class QuizBot:
     def __init__(self, admin_ids):
         self.db_path = 'quiz_bot.db'
         self.admin_ids = admin_ids
+        # Одно долгоживущее соединение: кэш страниц SQLite не теряется между запросами
+        self.conn = self._connect()
+        self._db_lock = threading.Lock()
         self.init_database()
-        self.user_states = {}
+        # Записи (sql, params), ещё не попавшие в БД (см. db_writer)
+        self._write_queue = asyncio.Queue()
+        # LRU поверх таблицы user_states: в памяти только недавно активные пользователи
+        self.user_states = collections.OrderedDict()
+        # file_id уже загруженных в Telegram картинок: повторно отправляем по id, без загрузки файла
+        with self._db_lock:
+            self._photo_ids = dict(self.conn.execute("SELECT name, file_id FROM photo_file_ids"))
+        # Кэш данных олимпиад: меняются только при загрузке/удалении через админку
+        self._years_cache = None
+        self._exercises_cache = {}
+        self._tasks_cache = {}
+        self._topic_exercises_cache = {}
+        # Собранные клавиатуры: 'years', ('year', год), ('topics', темы)
+        self._keyboards = {}
+        # Растёт при каждом сбросе кэша: клавиатуру, собранную до сброса, не запоминаем
+        self._cache_generation = 0
+        # Где геттер хранит свой результат: чтение кэша без обращения к БД (см. _cached)
+        self._cache_slots = {
+            self.get_years_from_db: lambda: self._years_cache,
+            self.get_years_keyboard: lambda: self._keyboards.get('years'),
+            self.get_exercises_for_year: lambda year: self._exercises_cache.get(year),
+            self.get_exercises_keyboard: lambda year: self._keyboards.get(('year', year)),
+            self.get_tasks_for_year_and_exercise: lambda year, excercise: self._tasks_cache.get((year, excercise)),
+            self.get_topic_exercises_keyboard: lambda topics: self._keyboards.get(('topics', tuple(topics))),
+        }
 
-    def init_database(self):
-        conn = sqlite3.connect(self.db_path)
+    def _remember_user_state(self, user_id, state):
+        """Кладёт состояние в LRU и вытесняет самые давние при переполнении."""
+        self.user_states[user_id] = state
+        self.user_states.move_to_end(user_id)
+        while len(self.user_states) > MAX_ACTIVE_USERS:
+            self.user_states.popitem(last=False)
+
+    def _set_user_state(self, user_id, state):
+        """Сохраняет состояние в памяти и ставит в очередь запись в БД.
+
+        В БД хранится только (год, номер задания): сама задача берётся из кэша.
+        """
+        self._remember_user_state(user_id, state)
+        task = state.get('current_task')
+        self._write_queue.put_nowait((SQL_UPSERT_USER_STATE, (
+            user_id, state['year'], task.excercise if task else None, int(time.time())
+        )))
+
+    def _drop_user_state(self, user_id):
+        self.user_states.pop(user_id, None)
+        self._write_queue.put_nowait((SQL_DELETE_USER_STATE, (user_id,)))
+
+    async def _get_user_state(self, user_id):
+        """Состояние пользователя из памяти, а после перезапуска или вытеснения — из БД."""
+        state = self.user_states.get(user_id)
+        if state is not None:
+            return state
+        row = await asyncio.to_thread(self.load_user_state, user_id)
+        if row is None:
+            return None
+        year, excercise = row
+        state = {'year': year}
+        tasks = (await self._cached(self.get_tasks_for_year_and_exercise, year, excercise)
+                 if excercise is not None else ())
+        if tasks:
+            task = tasks[0]
+            state.update(current_task=task, current_topics=task.topics, current_topic_str=task.topics_str)
+        self._remember_user_state(user_id, state)
+        return state
+
+    async def _cached(self, getter, *args):
+        """Результат getter(*args): из кэша сразу, а при промахе — в отдельном потоке.
+
+        Загрузка Excel идёт параллельно с другими обработчиками (block=False) и держит
+        self._db_lock всю транзакцию: ожидание блокировки на event loop остановило бы всех.
+        """
+        value = self._cache_slots[getter](*args)
+        if value is None:
+            value = await asyncio.to_thread(getter, *args)
+        return value
+
+    def _invalidate_cache(self):
+        """Сбрасывает кэш после изменения данных. Вызывается под self._db_lock."""
+        self._cache_generation += 1
+        self._years_cache = None
+        self._exercises_cache.clear()
+        self._tasks_cache.clear()
+        self._topic_exercises_cache.clear()
+        self._keyboards.clear()
+
+    def _connect(self):
+        """Открывает соединение с БД и применяет PRAGMA уровня соединения."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
         conn.execute("PRAGMA foreign_keys = ON")
-        c = conn.cursor()
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -20000")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        return conn
+
+    def close(self):
+        """Закрывает соединение; PRAGMA optimize обновляет статистику для запросов этого сеанса."""
+        with self._db_lock:
+            self.conn.execute("PRAGMA optimize")
+            self.conn.close()
+
+    @contextlib.contextmanager
+    def _bulk_write(self):
+        """Одна транзакция массовой записи. Вызывается под self._db_lock.
+
+        На время записи отключаем fsync и увеличиваем кэш страниц, после — возвращаем обычные PRAGMA.
+        """
+        conn = self.conn
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA cache_size = -65536")
+        try:
+            # commit в конце или rollback при ошибке. BEGIN явно: sqlite3 не открывает
+            # транзакцию перед DDL, и DROP/CREATE иначе выполнились бы вне неё
+            with conn:
+                conn.execute("BEGIN")
+                yield conn
+        finally:
+            conn.execute("PRAGMA cache_size = -20000")
+            conn.execute("PRAGMA synchronous = NORMAL")
+
+    @staticmethod
+    def _create_data_tables(c):
+        """Таблицы данных олимпиад (без индекса по темам — его создаёт вызывающий код)."""
         c.execute('''CREATE TABLE IF NOT EXISTS years
                      (id INTEGER PRIMARY KEY AUTOINCREMENT, year INTEGER UNIQUE)''')
         c.execute('''CREATE TABLE IF NOT EXISTS topics
@@ -65,43 +344,167 @@ class QuizBot:
                       answer_picture TEXT,
                       FOREIGN KEY (year_id) REFERENCES years (id) ON DELETE CASCADE,
                       UNIQUE(year_id, excercise))''')
+        # Таблица связей без rowid: пара (olympiad_id, topic_id) — сам ключ B-дерева,
+        # отдельный индекс под UNIQUE не нужен
         c.execute('''CREATE TABLE IF NOT EXISTS olympiad_topics
                      (olympiad_id INTEGER,
                       topic_id INTEGER,
                       FOREIGN KEY (olympiad_id) REFERENCES olympiads (id) ON DELETE CASCADE,
                       FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE,
-                      UNIQUE(olympiad_id, topic_id))''')
-        c.execute('''CREATE INDEX IF NOT EXISTS idx_olympiad_topics_topic ON olympiad_topics(topic_id)''')
-        c.execute('''CREATE INDEX IF NOT EXISTS idx_olympiad_topics_olympiad ON olympiad_topics(olympiad_id)''')
-        conn.commit()
-        conn.close()
+                      PRIMARY KEY (olympiad_id, topic_id)) WITHOUT ROWID''')
+
+    @classmethod
+    def _recreate_data_tables(cls, c):
+        """Удаляет и заново создаёт таблицы данных олимпиад вместо построчного DELETE FROM.
 
-    def save_user_to_db(self, user):
-        conn = sqlite3.connect(self.db_path)
+        Вызывается внутри транзакции _bulk_write. Таблицы удаляются от дочерних к родительским:
+        к моменту DROP на таблицу уже никто не ссылается, и неявный DELETE при
+        foreign_keys = ON не проверяет внешние ключи. Индекс по темам удаляется вместе
+        с olympiad_topics.
+        """
+        for table in ('olympiad_topics', 'olympiads', 'topics', 'years'):
+            c.execute(f"DROP TABLE IF EXISTS {table}")
+        cls._create_data_tables(c)
+
+    def init_database(self):
+        conn = self.conn
+        # WAL сохраняется в файле БД: читатели не блокируются записью
+        conn.execute("PRAGMA journal_mode = WAL")
         c = conn.cursor()
+        row = c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'olympiad_topics'").fetchone()
+        migrate = bool(row) and 'WITHOUT ROWID' not in row[0]
+        # Связи, оставшиеся от прерванной миграции прошлых версий
+        stranded = not migrate and c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'olympiad_topics_old'").fetchone()
+        if migrate or stranded:
+            # Миграция со старой схемы одной транзакцией: при ошибке старая таблица остаётся на месте
+            conn.execute("BEGIN")
+            try:
+                if migrate:
+                    c.execute("ALTER TABLE olympiad_topics RENAME TO olympiad_topics_old")
+                self._create_data_tables(c)
+                # Старая схема допускала связи с удалёнными заданиями и темами: их не переносим,
+                # иначе INSERT упадёт на внешнем ключе
+                c.execute('''INSERT OR IGNORE INTO olympiad_topics (olympiad_id, topic_id)
+                             SELECT olympiad_id, topic_id FROM olympiad_topics_old
+                             WHERE olympiad_id IN (SELECT id FROM olympiads)
+                               AND topic_id IN (SELECT id FROM topics)''')
+                c.execute("DROP TABLE olympiad_topics_old")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        else:
+            self._create_data_tables(c)
+        # Покрывающий индекс для поиска заданий по темам: topic_id -> olympiad_id без обращения к таблице.
+        # Обратное направление покрывает первичный ключ (olympiad_id, topic_id).
+        c.execute('''DROP INDEX IF EXISTS idx_olympiad_topics_topic''')
+        c.execute('''DROP INDEX IF EXISTS idx_olympiad_topics_olympiad''')
+        c.execute(SQL_CREATE_TOPIC_INDEX)
         c.execute('''CREATE TABLE IF NOT EXISTS users
                      (id INTEGER PRIMARY KEY, first_name TEXT, username TEXT)''')
-        c.execute('''INSERT OR IGNORE INTO users (id, first_name, username)
-                     VALUES (?, ?, ?)''', (user.id, user.first_name, user.username))
+        c.execute('''CREATE TABLE IF NOT EXISTS conversations
+                     (name TEXT, key TEXT, state INTEGER, PRIMARY KEY (name, key))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS photo_file_ids
+                     (name TEXT PRIMARY KEY, file_id TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS user_states
+                     (user_id INTEGER PRIMARY KEY, year INTEGER, excercise INTEGER, updated_at INTEGER)''')
+        c.execute("DELETE FROM user_states WHERE updated_at < ?", (int(time.time()) - USER_STATE_TTL,))
         conn.commit()
-        conn.close()
+
+    def save_batch_to_db(self, batch):
+        """Выполняет накопленные записи одной транзакцией, подряд идущие одинаковые запросы — одним executemany."""
+        with self._db_lock, self.conn:
+            for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                self.conn.executemany(sql, (params for _, params in group))
+
+    async def db_writer(self):
+        """Фоновая задача: пишет пользователей и их состояния из очереди пачками, одна транзакция на пачку."""
+        batch = []
+        try:
+            while True:
+                batch.append(await self._write_queue.get())
+                # Даём набраться одновременным обновлениям, чтобы записать их одним commit
+                await asyncio.sleep(WRITE_FLUSH_DELAY)
+                while len(batch) < WRITE_BATCH_SIZE and not self._write_queue.empty():
+                    batch.append(self._write_queue.get_nowait())
+                try:
+                    await asyncio.to_thread(self.save_batch_to_db, batch)
+                except Exception as e:
+                    logger.error(f"Error writing batch to DB: {e}")
+                batch = []
+        finally:
+            # При остановке дописываем всё, что ещё не попало в БД (все записи идемпотентны — повтор безопасен)
+            self.flush_write_queue(batch)
+
+    def flush_write_queue(self, batch=()):
+        """Синхронно записывает batch и всё, что осталось в очереди."""
+        batch = list(batch)
+        while not self._write_queue.empty():
+            batch.append(self._write_queue.get_nowait())
+        if batch:
+            self.save_batch_to_db(batch)
+
+    def load_user_state(self, user_id):
+        """(год, номер задания) из таблицы user_states или None."""
+        with self._db_lock:
+            return self.conn.execute(SQL_SELECT_USER_STATE, (user_id,)).fetchone()
+
+    def load_conversations(self, name):
+        """Состояния ConversationHandler `name`: {ключ-кортеж: состояние}."""
+        with self._db_lock:
+            rows = self.conn.execute(SQL_SELECT_CONVERSATIONS, (name,)).fetchall()
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    def save_conversation(self, name, key, new_state):
+        """Сохраняет одно состояние диалога; None означает завершённый диалог."""
+        with self._db_lock, self.conn:
+            if new_state is None:
+                self.conn.execute(SQL_DELETE_CONVERSATION, (name, json.dumps(key)))
+            else:
+                self.conn.execute(SQL_UPSERT_CONVERSATION, (name, json.dumps(key), new_state))
 
     def _clean_value(self, val):
+        if isinstance(val, float) and val.is_integer():
+            # calamine отдаёт все числа как float: 42.0 -> "42", как у openpyxl
+            val = int(val)
         if val is None or str(val).strip().lower() == "none" or str(val).strip() == "":
             return ""
         return str(val).strip()
     
-    def parse_excel_and_images(self, excel_path, image_dir, replace=True):
+    def _read_excel_rows(self, excel_source):
+        """Построчно читает первый лист книги: через calamine, если он установлен, иначе через openpyxl.
+
+        excel_source — путь к файлу или бинарный file-like объект.
+        """
+        if CalamineWorkbook is not None:
+            if isinstance(excel_source, (str, os.PathLike)):
+                workbook = CalamineWorkbook.from_path(excel_source)
+            else:
+                workbook = CalamineWorkbook.from_filelike(excel_source)
+            # calamine загружает весь лист в память уже в get_sheet_by_index; iter_rows лишь не строит
+            # из него второй полный список Python-объектов, как to_python(). Потоково читает только openpyxl
+            rows = workbook.get_sheet_by_index(0).iter_rows()
+        else:
+            workbook = openpyxl.load_workbook(excel_source, read_only=True, data_only=True)
+            rows = _until_blank_run(workbook.active.iter_rows(values_only=True))
         try:
-            logger.info(f"Parsing Excel: {excel_path}, replace={replace}")
-            workbook = openpyxl.load_workbook(excel_path)
-            sheet = workbook.active
-
-            if sheet.max_row < 2:
+            yield from rows
+        finally:
+            # обе библиотеки держат файл книги открытым до close()
+            workbook.close()
+
+    def parse_excel_and_images(self, excel_source, image_names, replace=True):
+        """Загружает задания из Excel в БД. Возвращает ImportResult или None при ошибке."""
+        logger.info(f"Parsing Excel: {getattr(excel_source, 'name', excel_source)}, replace={replace}")
+        reader = self._read_excel_rows(excel_source)
+        try:
+            headers = list(next(reader, None) or [])
+            first_row = next(reader, None)
+            if not headers or first_row is None:
                 logger.warning("Excel file is empty")
-                return False
-
-            headers = [cell.value for cell in sheet[1]]
+                return None
+            rows = itertools.chain([first_row], reader)
             logger.info(f"Headers: {headers}")
 
             required = ['Year', 'Excercise', 'Topic', 'Task', 'Hint', 'Answer']
@@ -109,55 +512,52 @@ class QuizBot:
                 if col not in headers:
                     raise ValueError(f"Missing column: {col}")
             idx = {col: headers.index(col) for col in required}
-
-            # Optional picture columns
-            pic_cols = {}
-            for col in ['Task_picture', 'Hint_picture', 'Answer_picture']:
-                if col in headers:
-                    pic_cols[col] = headers.index(col)
-
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            if replace:
-                c.execute("DELETE FROM olympiad_topics")
-                c.execute("DELETE FROM olympiads")
-                c.execute("DELETE FROM topics")
-                c.execute("DELETE FROM years")
-                logger.info("Cleared DB")
-
-            inserted_years = set()
-            inserted_topics = set()
-            inserted = 0
+            # Индексы колонок вычисляем один раз, в цикле — только доступ к кортежу
+            year_i, excercise_i, topic_i = idx['Year'], idx['Excercise'], idx['Topic']
+            task_i, hint_i, answer_i = idx['Task'], idx['Hint'], idx['Answer']
+
+            # Optional picture columns: индекс или None, если колонки нет
+            t_pic_i, h_pic_i, a_pic_i = (headers.index(col) if col in headers else None
+                                         for col in ('Task_picture', 'Hint_picture', 'Answer_picture'))
+
+            # dict вместо set: сохраняем порядок появления для INSERT
+            inserted_years = {}
+            inserted_topics = {}
+            parsed = []
             skipped = 0
 
-            for row_num in range(2, sheet.max_row + 1):
-                row = [sheet.cell(row=row_num, column=i + 1).value for i in range(len(headers))]
-                if not any(str(cell).strip() if cell else '' for cell in row):
+            width = len(headers)
+            for row_num, row in enumerate(rows, start=2):
+                if len(row) < width:
+                    # В read-only режиме строки без dimension-тега бывают короче заголовка
+                    row = list(row) + [None] * (width - len(row))
+                # Пустые строки (None у openpyxl, '' у calamine) отсекаем одной проверкой без str() по ячейкам
+                if not any(row):
                     continue
 
                 try:
-                    year = int(float(row[idx['Year']]))
+                    year = int(float(row[year_i]))
                 except (ValueError, TypeError):
                     skipped += 1
                     logger.warning(f"Invalid year in row {row_num}")
                     continue
 
                 try:
-                    excercise = int(float(row[idx['Excercise']]))
+                    excercise = int(float(row[excercise_i]))
                 except (ValueError, TypeError):
                     skipped += 1
                     logger.warning(f"Invalid excercise in row {row_num}")
                     continue
 
-                topic_raw = row[idx['Topic']]
-                task = row[idx['Task']]
-                hint = row[idx['Hint']]
-                answer = row[idx['Answer']]
+                topic_raw = row[topic_i]
+                task = row[task_i]
+                hint = row[hint_i]
+                answer = row[answer_i]
 
                 # Get picture filenames
-                t_pic = str(row[pic_cols['Task_picture']]).strip() if 'Task_picture' in pic_cols and row[pic_cols['Task_picture']] else None
-                h_pic = str(row[pic_cols['Hint_picture']]).strip() if 'Hint_picture' in pic_cols and row[pic_cols['Hint_picture']] else None
-                a_pic = str(row[pic_cols['Answer_picture']]).strip() if 'Answer_picture' in pic_cols and row[pic_cols['Answer_picture']] else None
+                t_pic = (self._clean_value(row[t_pic_i]) or None) if t_pic_i is not None else None
+                h_pic = (self._clean_value(row[h_pic_i]) or None) if h_pic_i is not None else None
+                a_pic = (self._clean_value(row[a_pic_i]) or None) if a_pic_i is not None else None
 
                 if not (year and excercise and topic_raw and (task or t_pic) and (hint or h_pic) and (answer or a_pic)):
                     skipped += 1
@@ -165,7 +565,8 @@ class QuizBot:
                     continue
 
                 # Разбиваем темы по запятой
-                topics_list = [t.strip() for t in str(topic_raw).split(',') if t.strip()]
+                # Через _clean_value: число-тема из calamine (7.0) даёт "7", как у openpyxl
+                topics_list = [t.strip() for t in self._clean_value(topic_raw).split(',') if t.strip()]
                 if not topics_list:
                     skipped += 1
                     logger.warning(f"No valid topics in row {row_num}")
@@ -177,106 +578,182 @@ class QuizBot:
 
                 # Validate picture files exist
                 for pic in [t_pic, h_pic, a_pic]:
-                    if pic and not os.path.exists(os.path.join(image_dir, pic)):
+                    if pic and pic not in image_names:
                         logger.warning(f"Picture file not found: {pic}")
 
-                # Вставляем год
-                c.execute("INSERT OR IGNORE INTO years (year) VALUES (?)", (year,))
                 if year not in inserted_years:
-                    inserted_years.add(year)
-                    logger.info(f"Added year: {year}")
+                    inserted_years[year] = None
+                    logger.debug("Added year: %s", year)
 
-                c.execute("SELECT id FROM years WHERE year = ?", (year,))
-                year_id = c.fetchone()[0]
-
-                # Вставляем темы
                 for topic_name in topics_list:
-                    c.execute("INSERT OR IGNORE INTO topics (name) VALUES (?)", (topic_name,))
                     if topic_name not in inserted_topics:
-                        inserted_topics.add(topic_name)
-                        logger.info(f"Added topic: {topic_name}")
-
-                # Вставляем задание
-                c.execute('''INSERT OR REPLACE INTO olympiads 
-                             (year_id, excercise, task, task_picture, 
-                              hint, hint_picture, answer, answer_picture)
-                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                          (year_id, excercise, task, t_pic, hint, h_pic, answer, a_pic))
-                
-                olympiad_id = c.lastrowid
-
-                # Связываем с темами
-                for topic_name in topics_list:
-                    c.execute("SELECT id FROM topics WHERE name = ?", (topic_name,))
-                    topic_id = c.fetchone()[0]
-                    c.execute('''INSERT OR IGNORE INTO olympiad_topics 
-                                 (olympiad_id, topic_id) VALUES (?, ?)''',
-                              (olympiad_id, topic_id))
-
-                inserted += 1
+                        inserted_topics[topic_name] = None
+                        logger.debug("Added topic: %s", topic_name)
+
+                parsed.append((year, excercise, topics_list, task, t_pic, hint, h_pic, answer, a_pic))
+
+            inserted = len(parsed)
+
+            # Вся загрузка — одна транзакция
+            with self._db_lock:
+                with self._bulk_write() as conn:
+                    c = conn.cursor()
+                    if replace:
+                        # Таблица связей создаётся без индекса по темам: построим его один раз
+                        # после вставки, а не будем поддерживать на каждой строке
+                        self._recreate_data_tables(c)
+                        logger.info("Cleared DB")
+
+                    # Годы и темы вставляем пачкой, id получаем одним запросом
+                    c.executemany(SQL_INSERT_YEAR, ((year,) for year in inserted_years))
+                    year_ids = dict(c.execute(SQL_SELECT_YEAR_IDS))
+
+                    c.executemany(SQL_INSERT_TOPIC, ((name,) for name in inserted_topics))
+                    topic_ids = dict(c.execute(SQL_SELECT_TOPIC_IDS))
+
+                    # Задания — одним executemany: существующая строка обновляется на месте
+                    # и сохраняет свой id, затем все id получаем одним запросом
+                    c.executemany(SQL_UPSERT_OLYMPIAD,
+                                  ((year_ids[year], excercise, task, t_pic, hint, h_pic, answer, a_pic)
+                                   for year, excercise, _, task, t_pic, hint, h_pic, answer, a_pic in parsed))
+                    olympiad_ids = {(year_id, excercise): olympiad_id
+                                    for year_id, excercise, olympiad_id in c.execute(SQL_SELECT_OLYMPIAD_IDS)}
+                    # При повторе задания в файле темы берутся из последней строки
+                    olympiad_topics = {olympiad_ids[(year_ids[year], excercise)]: topics_list
+                                       for year, excercise, topics_list, *_ in parsed}
+
+                    if not replace:
+                        # Темы обновлённых заданий заменяются, а не дополняются
+                        c.executemany(SQL_DELETE_OLYMPIAD_TOPICS,
+                                      ((olympiad_id,) for olympiad_id in olympiad_topics))
+
+                    # Связываем задания с темами: генератор вместо промежуточного списка
+                    c.executemany(SQL_INSERT_OLYMPIAD_TOPIC,
+                                  ((olympiad_id, topic_ids[name])
+                                   for olympiad_id, topics_list in olympiad_topics.items()
+                                   for name in topics_list))
+                    if replace:
+                        c.execute(SQL_CREATE_TOPIC_INDEX)
+
+                    # Статистика для планировщика: после массовой загрузки распределение данных меняется
+                    c.execute("ANALYZE")
+                self._invalidate_cache()
 
-            conn.commit()
-            conn.close()
             logger.info(f"Loaded: {inserted} exercises, {len(inserted_topics)} topics, {len(inserted_years)} years, skipped: {skipped}")
-            return True
+            return ImportResult(inserted, skipped)
 
         except Exception as e:
             logger.error(f"Error parsing Excel: {e}", exc_info=True)
-            return False
+            return None
+        finally:
+            reader.close()
 
     def clear_database(self):
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            c.execute("DELETE FROM olympiads")
-            c.execute("DELETE FROM topics")
-            c.execute("DELETE FROM years")
-            conn.commit()
-            conn.close()
+            with self._db_lock:
+                with self._bulk_write() as conn:
+                    c = conn.cursor()
+                    self._recreate_data_tables(c)
+                    c.execute(SQL_CREATE_TOPIC_INDEX)
+                self._invalidate_cache()
             logger.info("Database cleared successfully.")
         except Exception as e:
             logger.error(f"Error clearing database: {e}")
 
+    def forget_photo_ids(self, names=None):
+        """Сбрасывает file_id картинок с именами names (всех, если None): файлы на диске заменены."""
+        with self._db_lock, self.conn:
+            if names is None:
+                self._photo_ids.clear()
+                self.conn.execute("DELETE FROM photo_file_ids")
+            else:
+                for name in names:
+                    self._photo_ids.pop(name, None)
+                self.conn.executemany(SQL_DELETE_PHOTO_ID, ((name,) for name in names))
+
     def clear_images(self):
+        self.forget_photo_ids()
         try:
             if os.path.exists(IMAGE_DIR):
-                for filename in os.listdir(IMAGE_DIR):
-                    file_path = os.path.join(IMAGE_DIR, filename)
-                    try:
-                        if os.path.isfile(file_path):
-                            os.unlink(file_path)
-                            logger.info(f"Deleted image file: {filename}")
-                    except Exception as e:
-                        logger.error(f"Failed to delete {file_path}: {e}")
+                # scandir отдаёт тип файла вместе с именем — без отдельного stat на каждый файл
+                with os.scandir(IMAGE_DIR) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_file():
+                                os.unlink(entry.path)
+                                logger.debug("Deleted image file: %s", entry.name)
+                        except Exception as e:
+                            logger.error(f"Failed to delete {entry.path}: {e}")
             logger.info("All image files deleted.")
         except Exception as e:
             logger.error(f"Error in clear_images: {e}")
 
     def get_years_from_db(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute("SELECT year FROM years ORDER BY year")
-        years = [row[0] for row in c.fetchall()]
-        conn.close()
+        if self._years_cache is not None:
+            return self._years_cache
+        with self._db_lock:
+            c = self.conn.cursor()
+            c.execute(SQL_SELECT_YEARS)
+            # Кэшированные данные общие для всех пользователей — отдаём неизменяемые кортежи
+            years = tuple(row[0] for row in c.fetchall())
+            self._years_cache = years
         return years
 
+    def _memo_keyboard(self, key, build):
+        """Клавиатура из кэша по key, иначе build() (None — клавиатуры нет, не кэшируется).
+
+        Собирается один раз до следующего изменения данных. Если данные успели смениться
+        во время сборки, устаревшую клавиатуру отдаём, но не запоминаем.
+        """
+        keyboard = self._keyboards.get(key)
+        if keyboard is None:
+            generation = self._cache_generation
+            keyboard = build()
+            # Сброс кэша идёт под self._db_lock: между проверкой и записью он не вклинится
+            with self._db_lock:
+                if keyboard is not None and generation == self._cache_generation:
+                    self._keyboards[key] = keyboard
+        return keyboard
+
+    def get_years_keyboard(self):
+        """Клавиатура выбора года."""
+        def build():
+            years = self.get_years_from_db()
+            return ReplyKeyboardMarkup(chunks([str(year) for year in years], 4), one_time_keyboard=False)
+        return self._memo_keyboard('years', build)
+
     def get_exercises_for_year(self, year):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''SELECT o.excercise
-                     FROM olympiads o
-                     JOIN years y ON o.year_id = y.id
-                     WHERE y.year = ?
-                     ORDER BY o.excercise''', (year,))
-        exercises = [{'excercise': row[0]} for row in c.fetchall()]
-        conn.close()
-        return exercises   
+        cached = self._exercises_cache.get(year)
+        if cached is not None:
+            return cached
+        with self._db_lock:
+            c = self.conn.cursor()
+            c.execute(SQL_SELECT_EXERCISES_FOR_YEAR, (year,))
+            # Номера заданий года — просто кортеж чисел
+            exercises = tuple(row[0] for row in c.fetchall())
+            # Пустые результаты не кэшируем: год приходит из текста пользователя
+            if exercises:
+                self._exercises_cache[year] = exercises
+        return exercises
+
+    def get_exercises_keyboard(self, year):
+        """Клавиатура заданий года или None, если заданий нет."""
+        def build():
+            exercises = self.get_exercises_for_year(year)
+            if not exercises:
+                return None
+            rows = chunks([f"{year} задание {excercise}" for excercise in exercises], 3)
+            rows.append([BTN_BACK_TO_YEAR])
+            return ReplyKeyboardMarkup(rows, one_time_keyboard=False)
+        return self._memo_keyboard(('year', year), build)
 
     def get_all_exercises_by_topics_with_matching_topics(self, topic_list):
         """Возвращает все задания по указанным темам из всех годов с информацией о совпадающих темах"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
+        key = tuple(topic_list)
+        cached = self._topic_exercises_cache.get(key)
+        if cached is not None:
+            return cached
+
         # Создаём placeholder'ы для тем
         placeholders = ','.join('?' * len(topic_list))
         query = f'''
@@ -289,88 +766,68 @@ class QuizBot:
             GROUP BY y.year, o.excercise
             ORDER BY y.year, o.excercise
         '''
-        c.execute(query, topic_list)
-        results = []
-        for row in c.fetchall():
-            results.append({
-                'year': row[0],
-                'excercise': row[1],
-                'matching_topics': row[2]  # Все совпадающие темы для этого задания
-            })
-        conn.close()
+        with self._db_lock:
+            c = self.conn.cursor()
+            c.execute(query, topic_list)
+            # Кортежи (год, задание, совпадающие темы) прямо из курсора
+            results = tuple(c.fetchall())
+            if results:
+                self._topic_exercises_cache[key] = results
         return results
 
+    def get_topic_exercises_keyboard(self, topic_list):
+        """Клавиатура заданий по темам или None, если заданий нет."""
+        def build():
+            exercises_data = self.get_all_exercises_by_topics_with_matching_topics(topic_list)
+            if not exercises_data:
+                return None
+            # Формируем кнопки с указанием года и совпадающих тем
+            buttons = [f"{year} задание {excercise} ({matching_topics})"
+                       for year, excercise, matching_topics in exercises_data]
+            rows = chunks(buttons, 2)
+            rows.append([BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR])
+            return ReplyKeyboardMarkup(rows, one_time_keyboard=False)
+        return self._memo_keyboard(('topics', tuple(topic_list)), build)
+
     def get_tasks_for_year_and_exercise(self, year, excercise):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''SELECT o.id, o.excercise, o.task, o.task_picture,
-                            o.hint, o.hint_picture,
-                            o.answer, o.answer_picture
-                     FROM olympiads o
-                     JOIN years y ON o.year_id = y.id
-                     WHERE y.year = ? AND o.excercise = ?''', (year, excercise))
-        row = c.fetchone()
-        if not row:
-            conn.close()
-            return []
-        
-        task = {
-            'id': row[0],
-            'excercise': row[1],
-            'task': row[2],
-            't_pic': row[3],
-            'hint': row[4],
-            'h_pic': row[5],
-            'answer': row[6],
-            'a_pic': row[7]
-        }
-        
-        # Получаем темы задания
-        c.execute('''SELECT t.name 
-                     FROM topics t
-                     JOIN olympiad_topics ot ON t.id = ot.topic_id
-                     WHERE ot.olympiad_id = ?''', (task['id'],))
-        topics = [r[0] for r in c.fetchall()]
-        task['topics'] = topics
-        
-        conn.close()
-        return [task]
-    
-    def get_exercises_by_topics_and_year(self, year, topic_list):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        # Создаём placeholder'ы для тем
-        placeholders = ','.join('?' * len(topic_list))
-        query = f'''
-            SELECT DISTINCT o.excercise
-            FROM olympiads o
-            JOIN years y ON o.year_id = y.id
-            JOIN olympiad_topics ot ON o.id = ot.olympiad_id
-            JOIN topics t ON ot.topic_id = t.id
-            WHERE y.year = ? AND t.name IN ({placeholders})
-            ORDER BY o.excercise
-        '''
-        params = [year] + topic_list
-        c.execute(query, params)
-        exercises = [{'excercise': row[0]} for row in c.fetchall()]
-        conn.close()
-        return exercises
+        cached = self._tasks_cache.get((year, excercise))
+        if cached is not None:
+            return cached
+        # Пользователь, выбравший год, обычно листает несколько его заданий:
+        # загружаем весь год двумя запросами вместо двух запросов на каждое задание
+        with self._db_lock:
+            c = self.conn.cursor()
+            topics_by_task = {}
+            for olympiad_id, name in c.execute(SQL_SELECT_YEAR_TASK_TOPICS, (year,)):
+                topics_by_task.setdefault(olympiad_id, []).append(name)
+
+            for row in c.execute(SQL_SELECT_YEAR_TASKS, (year,)):
+                topics = tuple(topics_by_task.get(row[0], ()))
+                task = Task(
+                    *row[:8],
+                    topics=topics,
+                    # Тексты ответов собираем один раз при кэшировании, а не на каждое сообщение
+                    task_text=f"❓ Задача: {row[2] or ''}",
+                    hint_text=f"💡 Подсказка: {row[4] or ''}",
+                    answer_text=f"✅ Ответ: {row[6] or ''}",
+                    topics_str=", ".join(topics) if topics else "Без темы"
+                )
+                self._tasks_cache[(year, task.excercise)] = (task,)
+        return self._tasks_cache.get((year, excercise), ())
     
     # === Handlers ===
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.save_user_to_db(user)
-        years = self.get_years_from_db()
+        self._write_queue.put_nowait((SQL_INSERT_USER, (user.id, user.first_name, user.username)))
+        years = await self._cached(self.get_years_from_db)
         
-        keyboard = [[BTN_START]]
-        if user.id in self.admin_ids:
-            keyboard.append(["🛡️ Админка"])  # Кнопка админки всегда доступна для админов
+        # Кнопка админки всегда доступна для админов
+        keyboard = KB_START_ADMIN if user.id in self.admin_ids else KB_START
 
         await update.message.reply_text(
             f"Привет! Нажмите «{BTN_START}», чтобы выбрать год.",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup=keyboard
         )
         
         # Проверяем годы ТОЛЬКО если пользователь не админ
@@ -386,54 +843,42 @@ class QuizBot:
         text = update.message.text
 
         if text == BTN_START:
-            years = self.get_years_from_db()
-            buttons = [str(year) for year in years]
-            keyboard = chunks(buttons, 4)
             await update.message.reply_text(
                 "Выберите год:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
+                reply_markup=await self._cached(self.get_years_keyboard)
             )
             return CHOOSE_YEAR
 
         try:
             year = int(text)
         except ValueError:
-            years = self.get_years_from_db()
+            years = await self._cached(self.get_years_from_db)
             if not years:
                 await update.message.reply_text("Нет доступных годов.")
                 return ConversationHandler.END
-            buttons = [str(y) for y in years]
-            keyboard = chunks(buttons, 4)
             await update.message.reply_text(
                 "Выберите год из списка.",
-                reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
+                reply_markup=await self._cached(self.get_years_keyboard)
             )
             return CHOOSE_YEAR
 
         user_id = update.effective_user.id
-        exercises = self.get_exercises_for_year(year)
-        if not exercises:
+        keyboard = await self._cached(self.get_exercises_keyboard, year)
+        if keyboard is None:
             await update.message.reply_text("В этом году нет заданий.")
             return CHOOSE_YEAR
 
-        buttons = [f"{year} задание {ex['excercise']}" for ex in exercises]
-        keyboard = chunks(buttons, 3)
-        keyboard.append([BTN_BACK_TO_YEAR])
-
         await update.message.reply_text(
             f"Выберите задание для {year} года:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
+            reply_markup=keyboard
         )
 
-        self.user_states[user_id] = {
-            'year': year,
-            'exercises': exercises,
-        }
+        self._set_user_state(user_id, {'year': year})
         return CHOOSE_EXERCISE
 
     async def choose_exercise(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        state = self.user_states.get(user_id)
+        state = await self._get_user_state(user_id)
         if not state:
             return await self.start(update, context)
 
@@ -449,7 +894,7 @@ class QuizBot:
             await update.message.reply_text("Пожалуйста, выберите задание из списка.")
             return CHOOSE_EXERCISE
 
-        tasks = self.get_tasks_for_year_and_exercise(year, excercise)
+        tasks = await self._cached(self.get_tasks_for_year_and_exercise, year, excercise)
         if not tasks:
             await update.message.reply_text("Задание не найдено.")
             return CHOOSE_EXERCISE
@@ -457,33 +902,19 @@ class QuizBot:
         # Сохраняем полную информацию для "Задачи по теме"
         full_task = tasks[0]
         
-        # Получаем темы через таблицу связи
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''SELECT t.name 
-                     FROM topics t
-                     JOIN olympiad_topics ot ON t.id = ot.topic_id
-                     JOIN olympiads o ON ot.olympiad_id = o.id
-                     JOIN years y ON o.year_id = y.id
-                     WHERE y.year = ? AND o.excercise = ?''', (year, excercise))
-        topics = [row[0] for row in c.fetchall()]
-        conn.close()
-        topics_str = ", ".join(topics) if topics else "Без темы"
-
-        self.user_states[user_id] = {
+        self._set_user_state(user_id, {
             'year': year,
-            'exercises': state['exercises'],
             'current_task': full_task,
-            'current_topics': topics,        # список тем
-            'current_topic_str': topics_str  # для отображения
-        }
+            'current_topics': full_task.topics,        # список тем
+            'current_topic_str': full_task.topics_str  # для отображения
+        })
 
         await self.show_task(update, full_task)
         return TASK
 
     async def choose_topic_exercise(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        state = self.user_states.get(user_id)
+        state = await self._get_user_state(user_id)
         if not state:
             return await self.start(update, context)
 
@@ -505,7 +936,7 @@ class QuizBot:
             return CHOOSE_TOPIC_EXERCISE
 
         # Получаем задачу по году и номеру задания
-        tasks = self.get_tasks_for_year_and_exercise(year, excercise)
+        tasks = await self._cached(self.get_tasks_for_year_and_exercise, year, excercise)
         if not tasks:
             await update.message.reply_text("Задание не найдено.")
             return CHOOSE_TOPIC_EXERCISE
@@ -513,172 +944,206 @@ class QuizBot:
         # Обновляем состояние пользователя
         full_task = tasks[0]
         
-        # Получаем темы для нового задания
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''SELECT t.name 
-                    FROM topics t
-                    JOIN olympiad_topics ot ON t.id = ot.topic_id
-                    JOIN olympiads o ON ot.olympiad_id = o.id
-                    JOIN years y ON o.year_id = y.id
-                    WHERE y.year = ? AND o.excercise = ?''', (year, excercise))
-        new_topics = [row[0] for row in c.fetchall()]
-        conn.close()
-        topics_str = ", ".join(new_topics) if new_topics else "Без темы"
-
-        self.user_states[user_id] = {
+        self._set_user_state(user_id, {
             'year': year,
-            'exercises': self.get_exercises_for_year(year),  # Обновляем список заданий для этого года
             'current_task': full_task,
-            'current_topics': new_topics,
-            'current_topic_str': topics_str
-        }
+            'current_topics': full_task.topics,
+            'current_topic_str': full_task.topics_str
+        })
 
         await self.show_task(update, full_task)
         return TASK
 
-    async def show_task(self, update: Update, q):
-        task_text = q['task'] or ""
-        await update.message.reply_text(f"❓ Задача: {task_text}")
-        
-        if q['t_pic']:
-            pic_path = os.path.join(IMAGE_DIR, q['t_pic'])
-            if os.path.exists(pic_path):
-                await update.message.reply_photo(photo=pic_path)
-            else:
-                await update.message.reply_text(f"🖼️ Изображение задачи не найдено: {q['t_pic']}")
+    async def _current_task(self, user_id):
+        """Возвращает текущую задачу пользователя или None."""
+        state = await self._get_user_state(user_id)
+        return state.get('current_task') if state else None
+
+    async def _send_task_part(self, update: Update, text, pic, missing_text, keyboard):
+        """Отправляет текст части задачи и её картинку (если есть).
+
+        Клавиатура действий прикрепляется к последнему сообщению, а текст, помещающийся
+        в подпись, уходит вместе с картинкой: без картинки это одно сообщение.
+        """
+        if not pic:
+            await update.message.reply_text(text, reply_markup=keyboard)
+            return
+
+        if len(text) <= CAPTION_LIMIT:
+            if await self._send_photo(update, pic, caption=text, reply_markup=keyboard):
+                return
+            await update.message.reply_text(text)
+        else:
+            await update.message.reply_text(text)
+            if await self._send_photo(update, pic, reply_markup=keyboard):
+                return
 
-        keyboard = [
-            [BTN_HINT, BTN_ANSWER],
-            [BTN_TOPIC_EXERCISES, BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR]
-        ]
-        await update.message.reply_text(
-            "Выберите действие:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
-        )
+        await update.message.reply_text(f"🖼️ {missing_text} не найдено: {pic}", reply_markup=keyboard)
+
+    async def _send_photo(self, update: Update, pic, caption=None, reply_markup=None):
+        """Отправляет картинку по сохранённому file_id, а при первой отправке загружает файл и запоминает id.
+
+        Возвращает False, если файла картинки нет или Telegram его не принял.
+        """
+        file_id = self._photo_ids.get(pic)
+        if file_id:
+            try:
+                await update.message.reply_photo(photo=file_id, caption=caption, reply_markup=reply_markup)
+                return True
+            except BadRequest as e:
+                # Заново загружаем файл, только если Telegram отверг сам id
+                # ("Wrong file identifier/http url specified", "Wrong remote file identifier..."),
+                # прочие ошибки (например, слишком длинная подпись) повторная загрузка не исправит
+                if not _is_stale_file_id(e):
+                    raise
+                self._photo_ids.pop(pic, None)
+
+        # Файл читаем в отдельном потоке: PTB прочитал бы его синхронно внутри event loop
+        try:
+            photo = await asyncio.to_thread(_read_file, os.path.join(IMAGE_DIR, pic))
+        except FileNotFoundError:
+            return False
+        try:
+            message = await update.message.reply_photo(photo=photo, filename=pic, caption=caption,
+                                                     reply_markup=reply_markup)
+        except BadRequest as e:
+            # Telegram отверг сам файл (битая или слишком большая картинка из архива): вызывающий
+            # код отправит текст и клавиатуру отдельно, как при отсутствующем файле
+            logger.error(f"Failed to send picture {pic}: {e}")
+            return False
+        if message and message.photo:
+            file_id = message.photo[-1].file_id
+            self._photo_ids[pic] = file_id
+            self._write_queue.put_nowait((SQL_UPSERT_PHOTO_ID, (pic, file_id)))
+        return True
+
+    async def show_task(self, update: Update, q):
+        await self._send_task_part(update, q.task_text, q.t_pic,
+                                   "Изображение задачи", KB_TASK)
 
     async def show_hint(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = update.effective_user.id
-        state = self.user_states.get(user_id)
-        if not state or 'current_task' not in state:
+        q = await self._current_task(update.effective_user.id)
+        if not q:
             await update.message.reply_text("Нет активной задачи.")
             return CHOOSE_YEAR
 
-        q = state['current_task']
-        hint_text = q['hint'] or ""
-        await update.message.reply_text(f"💡 Подсказка: {hint_text}")
-        
-        if q['h_pic']:
-            pic_path = os.path.join(IMAGE_DIR, q['h_pic'])
-            if os.path.exists(pic_path):
-                await update.message.reply_photo(photo=pic_path)
-            else:
-                await update.message.reply_text(f"🖼️ Изображение подсказки не найдено: {q['h_pic']}")
-
-        keyboard = [
-            [BTN_ANSWER],
-            [BTN_TOPIC_EXERCISES, BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR]
-        ]
-        await update.message.reply_text(
-            "Выберите действие:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
-        )
+        await self._send_task_part(update, q.hint_text, q.h_pic,
+                                   "Изображение подсказки", KB_HINT)
         return HINT
 
     async def show_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = update.effective_user.id
-        state = self.user_states.get(user_id)
-        if not state or 'current_task' not in state:
+        q = await self._current_task(update.effective_user.id)
+        if not q:
             await update.message.reply_text("Нет активной задачи.")
             return CHOOSE_YEAR
 
-        q = state['current_task']
-        answer_text = q['answer'] or ""
-        await update.message.reply_text(f"✅ Ответ: {answer_text}")
-        
-        if q['a_pic']:
-            pic_path = os.path.join(IMAGE_DIR, q['a_pic'])
-            if os.path.exists(pic_path):
-                await update.message.reply_photo(photo=pic_path)
-            else:
-                await update.message.reply_text(f"🖼️ Изображение ответа не найдено: {q['a_pic']}")
-
-        keyboard = [
-            [BTN_TOPIC_EXERCISES, BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR]
-        ]
-        await update.message.reply_text(
-            "Выберите действие:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
-        )
+        await self._send_task_part(update, q.answer_text, q.a_pic,
+                                   "Изображение ответа", KB_ANSWER)
         return ANSWER
 
     async def show_topic_exercises(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        state = self.user_states.get(user_id)
+        state = await self._get_user_state(user_id)
         if not state or 'current_topics' not in state:
             return await self.start(update, context)
 
         topics = state['current_topics']
-        exercises_data = self.get_all_exercises_by_topics_with_matching_topics(topics)
-        if not exercises_data:
+        keyboard = await self._cached(self.get_topic_exercises_keyboard, topics)
+        if keyboard is None:
             await update.message.reply_text("Нет других заданий по этим темам.")
             return await self.show_task_from_state(update, context)
 
-        # Формируем кнопки с указанием года и совпадающих тем
-        buttons = []
-        for data in exercises_data:
-            button_text = f"{data['year']} задание {data['excercise']} ({data['matching_topics']})"
-            buttons.append(button_text)
-
-        keyboard = chunks(buttons, 2)
-        keyboard.append([BTN_BACK_TO_EXERCISES, BTN_BACK_TO_YEAR])
-
         await update.message.reply_text(
             f"Задания по темам {', '.join(topics)} по всем годам:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
+            reply_markup=keyboard
         )
         return CHOOSE_TOPIC_EXERCISE
 
     async def show_task_from_state(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = update.effective_user.id
-        state = self.user_states.get(user_id)
-        if not state or 'current_task' not in state:
+        q = await self._current_task(update.effective_user.id)
+        if not q:
             return await self.start(update, context)
-        await self.show_task(update, state['current_task'])
+        await self.show_task(update, q)
         return TASK
 
     async def back_to_year_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Возвращает к выбору года"""
         user_id = update.effective_user.id
-        self.user_states.pop(user_id, None)  # сбрасываем состояние пользователя
+        self._drop_user_state(user_id)  # сбрасываем состояние пользователя
         return await self.choose_year(update, context)
 
     async def back_to_exercises(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Возвращает к списку заданий текущего года"""
         user_id = update.effective_user.id
-        state = self.user_states.get(user_id)
-        if not state or 'year' not in state or 'exercises' not in state:
+        state = await self._get_user_state(user_id)
+        if not state or 'year' not in state:
             return await self.start(update, context)
 
         year = state['year']
-        exercises = state['exercises']
-        buttons = [f"{year} задание {ex['excercise']}" for ex in exercises]
-        keyboard = chunks(buttons, 3)
-        keyboard.append([BTN_BACK_TO_YEAR])
+        keyboard = await self._cached(self.get_exercises_keyboard, year)
+        if keyboard is None:
+            # Год удалён загрузкой новых данных
+            return await self.start(update, context)
 
         await update.message.reply_text(
             f"Выберите задание для {year} года:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=False)
+            reply_markup=keyboard
         )
         return CHOOSE_EXERCISE
 
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.user_states.pop(update.effective_user.id, None)
+        self._drop_user_state(update.effective_user.id)
         await update.message.reply_text("Операция отменена.", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
     # === Admin handlers ===
 
+    @staticmethod
+    def _read_excel_from_zip(zip_source):
+        """Читает из архива в память только Excel-файл (первый в корне архива), без записи на диск.
+
+        Картинки не распаковываются: возвращаются только их имена.
+        Возвращает (имя Excel или None, BytesIO с его содержимым или None, {имя: ZipInfo}).
+        """
+        excel_name = excel = None
+        images = {}
+        with zipfile.ZipFile(zip_source, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                # Берём только файлы из корня архива; basename заодно защищает от путей вида ../
+                name = os.path.basename(info.filename)
+                if info.is_dir() or name != info.filename:
+                    continue
+                if name.lower().endswith(IMAGE_EXTS):
+                    images[name] = info
+                elif excel_name is None and name.endswith(('.xlsx', '.xls')):
+                    # Книга сама является ZIP-архивом и читается с произвольным доступом:
+                    # отдаём парсеру BytesIO, а не поток распаковки
+                    excel_name = name
+                    excel = io.BytesIO(zip_ref.read(info))
+                    excel.name = name
+        return excel_name, excel, images
+
+    def _install_images(self, zip_source, images):
+        """Пишет картинки из архива сразу в IMAGE_DIR, без промежуточной распаковки.
+
+        Возвращает имена картинок, которые записать не удалось.
+        """
+        installed = []
+        failed = []
+        with zipfile.ZipFile(zip_source, 'r') as zip_ref:
+            for name, info in images.items():
+                try:
+                    with zip_ref.open(info) as src, open(os.path.join(IMAGE_DIR, name), 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                except Exception as e:
+                    logger.error(f"Failed to install image {name}: {e}")
+                    failed.append(name)
+                else:
+                    installed.append(name)
+        # Файлы с этими именами могли смениться: старые file_id больше не подходят
+        self.forget_photo_ids(installed)
+        return failed
+
     async def admin_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         logger.info(f"Попытка доступа к админке от пользователя ID={user_id}, админы={self.admin_ids}")
@@ -687,31 +1152,16 @@ class QuizBot:
             await update.message.reply_text(f"❌ Доступ запрещён. Ваш ID: {user_id}")
             return ConversationHandler.END
 
-        keyboard = [
-            ['📁 Загрузить данные', '📥 Дополнить данные'],
-            ['🧹 Удалить данные', '↩️ Выйти']
-        ]
-        await update.message.reply_text(
-            "🛡️ Админ-панель:\n"
-            "• 📁 — заменить все данные\n"
-            "• 📥 — добавить к существующим\n"
-            "• 🧹 — удалить всё",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        )
-        return ADMIN_MENU
+        return await self.admin_menu_template(update, context)
 
     async def admin_menu_template(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Вспомогательный метод для возврата в главное меню админки"""
-        keyboard = [
-            ['📁 Загрузить данные', '📥 Дополнить данные'],
-            ['🧹 Удалить данные', '↩️ Выйти']
-        ]
         await update.message.reply_text(
             "🛡️ Админ-панель:\n"
             "• 📁 — заменить все данные\n"
             "• 📥 — добавить к существующим\n"
             "• 🧹 — удалить всё",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup=KB_ADMIN_MENU
         )
         return ADMIN_MENU
 
@@ -721,72 +1171,86 @@ class QuizBot:
             await update.message.reply_text("❌ Доступ запрещён.", reply_markup=ReplyKeyboardRemove())
             return ConversationHandler.END
 
-        choice = update.message.text
-        if choice == "↩️ Выйти":
-            await update.message.reply_text("Вы вышли.", reply_markup=ReplyKeyboardRemove())
-            return ConversationHandler.END
-        elif choice == "📁 Загрузить данные":
-            await update.message.reply_text("Отправьте ZIP-архив с Excel и изображениями.")
-            return ADMIN_UPLOAD_REPLACE
-        elif choice == "📥 Дополнить данные":
-            await update.message.reply_text("Отправьте ZIP-архив с Excel и изображениями для дополнения.")
-            return ADMIN_UPLOAD_APPEND
-        elif choice == "🧹 Удалить данные":
-            await update.message.reply_text("Точно удалить все данные?", reply_markup=ReplyKeyboardMarkup([['✅ Да', '❌ Нет']]))
-            return ADMIN_CONFIRM_CLEAR
-        else:
+        action = ADMIN_ACTIONS.get(update.message.text)
+        if action is None:
             await update.message.reply_text("Выберите действие из меню.")
             return ADMIN_MENU
 
+        text, keyboard, next_state = action
+        await update.message.reply_text(text, reply_markup=keyboard)
+        return next_state
+
     async def admin_upload_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE, replace=True):
         if not update.message.document or not update.message.document.file_name.endswith('.zip'):
             await update.message.reply_text("Отправьте ZIP-архив.")
             return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
 
         file = await update.message.document.get_file()
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            zip_path = os.path.join(tmp_dir, "data.zip")
-            await file.download_to_drive(zip_path)
+        # Архив держим в памяти: после скачивания он и так уже в RAM, лишняя запись на диск не нужна
+        archive = io.BytesIO()
+        await file.download_to_memory(archive)
+        archive.seek(0)
+        # Не-ZIP отсекаем по первым байтам, не запуская распаковку
+        if archive.read(4) != ZIP_MAGIC:
+            await update.message.reply_text("Неверный ZIP-файл.")
+            return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
+        archive.seek(0)
 
-            try:
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(tmp_dir)
-            except zipfile.BadZipFile:
-                await update.message.reply_text("Неверный ZIP-файл.")
-                return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
-
-            # Find Excel file
-            excel_files = [f for f in os.listdir(tmp_dir) if f.endswith(('.xlsx', '.xls'))]
-            if not excel_files:
-                await update.message.reply_text("В архиве нет Excel-файла.")
-                return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
-
-            excel_path = os.path.join(tmp_dir, excel_files[0])
-
-            # Copy images to persistent dir
-            for item in os.listdir(tmp_dir):
-                if item.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    src = os.path.join(tmp_dir, item)
-                    dst = os.path.join(IMAGE_DIR, item)
-                    shutil.copy(src, dst)
-
-            success = self.parse_excel_and_images(excel_path, tmp_dir, replace=replace)
-
-        if success:
-            await update.message.reply_text("✅ Данные успешно загружены!")
-            # Возвращаемся в главное меню админки, а не завершаем диалог
-            return await self.admin_menu_template(update, context)
-        else:
+        try:
+            excel_name, excel, images = await asyncio.to_thread(self._read_excel_from_zip, archive)
+        except zipfile.BadZipFile:
+            await update.message.reply_text("Неверный ZIP-файл.")
+            return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
+
+        if excel is None:
+            await update.message.reply_text("В архиве нет Excel-файла.")
+            return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
+
+        # .xlsx — тоже ZIP: битый или переименованный файл не отдаём парсеру
+        if excel_name.endswith('.xlsx') and excel.getvalue()[:4] != ZIP_MAGIC:
+            await update.message.reply_text("Excel-файл в архиве повреждён.")
+            return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
+
+        # Разбор Excel и запись в БД — в отдельном потоке, чтобы не блокировать event loop
+        # Excel может ссылаться и на картинки из прошлых загрузок, уже лежащие в IMAGE_DIR
+        available = await asyncio.to_thread(_list_files, IMAGE_DIR)
+        available.update(images)
+        result = await asyncio.to_thread(self.parse_excel_and_images, excel, available, replace)
+
+        if not result:
             await update.message.reply_text("❌ Ошибка при загрузке данных.")
             return ADMIN_UPLOAD_REPLACE if replace else ADMIN_UPLOAD_APPEND
 
+        # Картинки пишем только после успешной загрузки: при битом Excel
+        # не засоряем IMAGE_DIR файлами, на которые никто не ссылается.
+        # Данные уже в БД: ошибка записи картинок не отменяет загрузку, но админ должен о ней знать
+        try:
+            failed_images = await asyncio.to_thread(self._install_images, archive, images)
+        except Exception as e:
+            logger.error(f"Error installing images: {e}", exc_info=True)
+            failed_images = list(images)
+
+        text = (f"✅ Данные успешно загружены!\n"
+                f"Заданий: {result.inserted}, пропущено строк: {result.skipped}")
+        if failed_images:
+            text += f"\n⚠️ Не удалось сохранить изображения: {', '.join(failed_images)}"
+        await update.message.reply_text(text)
+        # Возвращаемся в главное меню админки, а не завершаем диалог
+        return await self.admin_menu_template(update, context)
+
+    async def admin_upload_replace(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await self.admin_upload_file(update, context, replace=True)
+
+    async def admin_upload_append(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await self.admin_upload_file(update, context, replace=False)
+
     async def admin_confirm_clear(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.message.text == "✅ Да":
-            self.clear_database()
-            self.clear_images()
+            await asyncio.to_thread(self.clear_database)
+            await asyncio.to_thread(self.clear_images)
             
             # Проверка
-            years = self.get_years_from_db()
+            years = await asyncio.to_thread(self.get_years_from_db)
             images_count = len(os.listdir(IMAGE_DIR)) if os.path.exists(IMAGE_DIR) else 0
             
             await update.message.reply_text(
@@ -801,6 +1265,73 @@ class QuizBot:
             return await self.admin_menu_template(update, context)
 
 
+class SQLitePersistence(BasePersistence):
+    """Persistence для состояний диалогов в БД бота.
+
+    В отличие от PicklePersistence, который перезаписывает весь файл при каждом изменённом
+    состоянии, здесь изменение одного диалога — одна строка в таблице conversations.
+    Бот не использует user_data/chat_data/bot_data, поэтому хранятся только диалоги.
+    """
+
+    def __init__(self, quiz_bot, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.quiz_bot = quiz_bot
+
+    # Обращения к БД — в отдельном потоке: self._db_lock может держать идущая загрузка Excel,
+    # и ожидание блокировки не должно останавливать event loop
+
+    async def get_conversations(self, name):
+        return await asyncio.to_thread(self.quiz_bot.load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        await asyncio.to_thread(self.quiz_bot.save_conversation, name, key, new_state)
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+
 # === Main ===
 
 async def main():
@@ -818,7 +1349,7 @@ async def main():
     
     logger.info(f"Администраторы: {admin_ids}")
     quiz_bot = QuizBot(admin_ids=admin_ids)
-    persistence = PicklePersistence(filepath="conversation_states.pkl")
+    persistence = SQLitePersistence(quiz_bot)
     app = Application.builder().token(TOKEN).persistence(persistence).build()
 
     conv_handler = ConversationHandler(
@@ -826,7 +1357,7 @@ async def main():
         states={
             CHOOSE_YEAR: [
                 MessageHandler(filters.Text([BTN_START, BTN_BACK_TO_YEAR]), quiz_bot.choose_year),
-                MessageHandler(filters.Text(["🛡️ Админка"]), quiz_bot.admin_start),
+                MessageHandler(filters.Text([BTN_ADMIN]), quiz_bot.admin_start),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_bot.choose_year)
             ],
             CHOOSE_EXERCISE: [
@@ -868,19 +1399,23 @@ async def main():
     admin_handler = ConversationHandler(
         entry_points=[
             CommandHandler('admin', quiz_bot.admin_start),
-            MessageHandler(filters.Text(["🛡️ Админка"]), quiz_bot.admin_start)  # Дублирующий обработчик
+            MessageHandler(filters.Text([BTN_ADMIN]), quiz_bot.admin_start)  # Дублирующий обработчик
         ],
         states={
             ADMIN_MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_bot.admin_menu)],
+            # Загрузка и очистка идут долго: block=False, чтобы Application не ждал их
+            # и продолжал обрабатывать обновления остальных пользователей
             ADMIN_UPLOAD_REPLACE: [
-                MessageHandler(filters.Document.ZIP, quiz_bot.admin_upload_file),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: quiz_bot.admin_upload_file(u, c, replace=True))
+                MessageHandler(filters.Document.ZIP, quiz_bot.admin_upload_replace, block=False),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_bot.admin_upload_replace)
             ],
             ADMIN_UPLOAD_APPEND: [
-                MessageHandler(filters.Document.ZIP, lambda u, c: quiz_bot.admin_upload_file(u, c, replace=False)),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: quiz_bot.admin_upload_file(u, c, replace=False))
+                MessageHandler(filters.Document.ZIP, quiz_bot.admin_upload_append, block=False),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_bot.admin_upload_append)
             ],
-            ADMIN_CONFIRM_CLEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_bot.admin_confirm_clear)]
+            ADMIN_CONFIRM_CLEAR: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, quiz_bot.admin_confirm_clear, block=False)
+            ]
         },
         fallbacks=[
             CommandHandler('cancel', quiz_bot.cancel),
@@ -898,19 +1433,30 @@ async def main():
     await app.initialize()
     await app.start()
     await app.updater.start_polling()
+    db_writer = asyncio.create_task(quiz_bot.db_writer())
     logger.info("Бот работает.")
 
+    # Ждём сигнала остановки вместо периодических пробуждений
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # На Windows обработчики сигналов в loop недоступны: там Ctrl+C отменяет main() сам
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except KeyboardInterrupt:
+        await stop_event.wait()
         logger.info("Остановка...")
     finally:
         await app.updater.stop()
         await app.stop()
+        db_writer.cancel()
+        await asyncio.gather(db_writer, return_exceptions=True)
+        # Если задача была отменена до первого запуска, её finally не выполнялся
+        quiz_bot.flush_write_queue()
         await app.shutdown()
+        quiz_bot.close()
 
 
 if __name__ == '__main__':
-    import asyncio
     asyncio.run(main())
\ No newline at end of file